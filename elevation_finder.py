@@ -1,84 +1,422 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import numpy as np
 import time
-from typing import List, Tuple, Optional
+import random
+import threading
+import sqlite3
+from collections import OrderedDict, deque
+from typing import Callable, Iterable, List, Tuple, Optional
 import io
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+CACHE_PATH = "elev_cache.db"
+EPQS_SOURCE = "epqs"
+FEET_PER_METER = 3.28084
+
+def round_coordinates(lat, lon):
+    """
+    Round coordinates to 5 decimals (~1 m) for scalars or arrays alike
+    Shared by the cache key and CSV de-duplication so both group points identically
+    """
+    return np.round(np.asarray(lat, dtype=np.float64), 5), np.round(np.asarray(lon, dtype=np.float64), 5)
+
+class ElevationCache:
+    """
+    Memo of successful elevation lookups keyed on coordinates rounded to 5 decimals (~1 m)
+    Keeps an in-process LRU and optionally persists to SQLite between sessions.
+    Entries are tagged with their source so other services never answer for EPQS
+    """
+    def __init__(self, path: Optional[str] = None, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self.memo: "OrderedDict[Tuple[str, float, float], float]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS elevations "
+                "(source TEXT, lat REAL, lon REAL, elevation_ft REAL, PRIMARY KEY (source, lat, lon))"
+            )
+            self.db.commit()
+
+    @staticmethod
+    def key(lat: float, lon: float) -> Tuple[float, float]:
+        lat, lon = round_coordinates(lat, lon)
+        return float(lat), float(lon)
+
+    def _remember(self, key: Tuple[str, float, float], elevation: float):
+        self.memo[key] = elevation
+        self.memo.move_to_end(key)
+        if len(self.memo) > self.maxsize:
+            self.memo.popitem(last=False)
+
+    def get(self, lat: float, lon: float, source: str = EPQS_SOURCE) -> Optional[float]:
+        """Return the elevation cached for this source, or None on a miss"""
+        key = (source, *self.key(lat, lon))
+        with self.lock:
+            if key in self.memo:
+                self.memo.move_to_end(key)
+                return self.memo[key]
+            if self.db is None:
+                return None
+            row = self.db.execute(
+                "SELECT elevation_ft FROM elevations WHERE source = ? AND lat = ? AND lon = ?", key
+            ).fetchone()
+            if row is None:
+                return None
+            self._remember(key, row[0])
+            return row[0]
+
+    def update(self, items: Iterable[Tuple[float, float, float]], source: str = EPQS_SOURCE):
+        """Store (lat, lon, elevation) triples from one source in a single transaction"""
+        rows = [(source, *self.key(lat, lon), elevation) for lat, lon, elevation in items]
+        with self.lock:
+            for source, lat, lon, elevation in rows:
+                self._remember((source, lat, lon), elevation)
+            if self.db is not None and rows:
+                self.db.executemany("INSERT OR REPLACE INTO elevations VALUES (?, ?, ?, ?)", rows)
+                self.db.commit()
+
+    def put(self, lat: float, lon: float, elevation: float, source: str = EPQS_SOURCE):
+        self.update([(lat, lon, elevation)], source)
+
+class JitteredRetry(Retry):
+    """urllib3 Retry whose exponential backoff is spread by +/-50% to avoid synchronized retries"""
+    def get_backoff_time(self) -> float:
+        return super().get_backoff_time() * random.uniform(0.5, 1.5)
+
+class TokenBucket:
+    """
+    Adaptive client-side rate limiter
+    Refills at `rate` tokens/sec up to `capacity`; the rate halves on 429/5xx
+    and climbs back toward `max_rate` while responses keep succeeding
+    """
+    def __init__(self, rate: float = 5.0, capacity: int = 10,
+                 min_rate: float = 0.5, max_rate: float = 20.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate, self.blocked_until - now)
+
+    def consume(self):
+        """Block until a token is available"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        """Speed up by a fraction of the remaining headroom"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + (self.max_rate - self.rate) * 0.1)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        """Halve the rate and, if the server asked, pause until Retry-After has passed"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * 0.5)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def record(self, status: int, retry_after: Optional[str] = None):
+        """Adjust the rate from an HTTP response status"""
+        if status == 429 or status >= 500:
+            self.on_throttle(parse_retry_after(retry_after))
+        elif status == 200:
+            self.on_success()
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given in seconds; HTTP-date values are ignored"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
 
 class USGSElevationFinder:
-    def __init__(self):
+    def __init__(self, cache_path: Optional[str] = CACHE_PATH, batch_url: Optional[str] = None):
         """Initialize the ElevationFinder using USGS API"""
         self.api_url = "https://epqs.nationalmap.gov/v1/json"
+        self._static_params = {'wkid': 4326, 'units': 'Feet', 'includeDate': 'false'}
+        
+        # Reuse one pooled HTTPS connection across calls instead of a new handshake per point
+        self.session = requests.Session()
+        retry = JitteredRetry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+            respect_retry_after_header=True,
+            raise_on_status=False  # hand the final response back so the token bucket sees it
+        )
+        
+        # Upper bound on in-flight requests for bulk processing - be respectful to USGS
+        self.max_workers = 8
         
-    def get_elevation_usgs(self, lat: float, lon: float, retry_count: int = 3) -> Optional[float]:
+        # One keep-alive connection per worker; pool_block makes extra threads (e.g. other
+        # sessions sharing this finder) wait for a warm connection instead of opening and
+        # discarding new ones
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.max_workers,
+                              pool_block=True, max_retries=retry)
+        self.session.mount('https://', adapter)
+        
+        # USGS EPQS only answers one point per request. batch_url may point at an
+        # Open-Elevation compatible `POST /api/v1/lookup` service to resolve
+        # batch_size points per request; chunks fall back to EPQS on failure.
+        # Such services are usually SRTM-based and far less accurate than EPQS.
+        self.batch_url = batch_url
+        self.batch_size = 100
+        self.bucket = TokenBucket()
+        self.cache = ElevationCache(cache_path)
+        
+    def get_elevation_usgs(self, lat: float, lon: float, use_cache: bool = True) -> Optional[float]:
         """
         Get elevation using USGS National Map Elevation Point Query Service
-        High accuracy for US locations, free, with retry logic
+        High accuracy for US locations, free, with caching; retries are handled by the session
         """
-        for attempt in range(retry_count):
-            try:
-                url = f"{self.api_url}?x={lon}&y={lat}&wkid=4326&units=Feet&includeDate=false"
-                response = requests.get(url, timeout=15)
-                
-                if response.status_code == 200:
+        if use_cache:
+            cached = self.cache.get(lat, lon)
+            if cached is not None:
+                return cached
+        
+        elevation = self._query_point(lat, lon)
+        if elevation is not None:
+            self.cache.put(lat, lon, elevation)
+        return elevation
+
+    def _record_response(self, response: requests.Response):
+        """
+        Feed a response to the token bucket, including the attempts urllib3 retried
+        internally - each took a request slot and any 429/5xx among them must slow us down
+        """
+        retries = getattr(response.raw, 'retries', None)
+        for attempt in (retries.history if retries else ()):
+            self.bucket.reserve()
+            if attempt.status is not None and (attempt.status == 429 or attempt.status >= 500):
+                self.bucket.on_throttle()
+        self.bucket.record(response.status_code, response.headers.get('Retry-After'))
+
+    def _query_point(self, lat: float, lon: float) -> Optional[float]:
+        """Single EPQS request, bypassing the cache"""
+        try:
+            self.bucket.consume()
+            response = self.session.get(
+                self.api_url,
+                params={**self._static_params, 'x': lon, 'y': lat},
+                timeout=15
+            )
+            self._record_response(response)
+            
+            if response.status_code == 200:
+                # A malformed body (null, a list, a non-numeric value) only fails this point
+                try:
                     data = response.json()
                     if 'value' in data and data['value'] != -1000000:
                         return float(data['value'])
-                    
-                # If we got a valid response but no data, don't retry
-                if response.status_code == 200:
+                except (ValueError, KeyError, TypeError):
                     return None
-                    
-            except requests.exceptions.Timeout:
-                if attempt < retry_count - 1:
-                    time.sleep(1)  # Wait before retry
-                    continue
+                
+        except requests.exceptions.Timeout:
+            return None
+        except requests.exceptions.RequestException as e:
+            st.warning(f"Error for point ({lat}, {lon}): {str(e)}")
+        
+        return None
+
+    def _query_batch(self, lats: np.ndarray, lons: np.ndarray) -> Optional[List[Optional[float]]]:
+        """One bulk POST to batch_url; returns None if the service couldn't answer"""
+        payload = {'locations': [
+            {'latitude': lat, 'longitude': lon} for lat, lon in zip(lats.tolist(), lons.tolist())
+        ]}
+        try:
+            self.bucket.consume()
+            response = self.session.post(self.batch_url, json=payload, timeout=15)
+            self._record_response(response)
+            if response.status_code != 200:
                 return None
-            except Exception as e:
-                if attempt < retry_count - 1:
-                    time.sleep(1)
-                    continue
-                st.warning(f"Error for point ({lat}, {lon}): {str(e)}")
+            results = response.json()['results']
+            if len(results) != len(lats):
                 return None
+            # Open-Elevation reports metres
+            return [
+                float(r['elevation']) * FEET_PER_METER if r.get('elevation') is not None else None
+                for r in results
+            ]
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError, AttributeError):
+            # Malformed bodies are treated like an unavailable service so the chunk falls back to EPQS
+            return None
+
+    def get_elevations_batch(self, lats: np.ndarray, lons: np.ndarray,
+                             on_progress: Optional[Callable[[int], None]] = None
+                             ) -> Tuple[List[Optional[float]], np.ndarray]:
+        """
+        Get elevations for many points on a thread pool, bypassing the cache
+        Returns the elevations and a mask of those answered by batch_url rather than EPQS,
+        and reports the running number of resolved points to on_progress(done)
+        """
+        total = len(lats)
+        elevations: List[Optional[float]] = [None] * total
+        from_batch = np.zeros(total, dtype=bool)
+        done = 0
         
-        return None
+        def query_point(i: int) -> List[Optional[float]]:
+            return [self._query_point(float(lats[i]), float(lons[i]))]
+        
+        # Each task resolves the points starting at its index; per-point fallbacks for
+        # failed bulk chunks are queued ahead of the remaining tasks
+        if self.batch_url:
+            tasks = (
+                (start, self._query_batch, lats[start:start + self.batch_size], lons[start:start + self.batch_size])
+                for start in range(0, total, self.batch_size)
+            )
+        else:
+            tasks = ((i, query_point, i) for i in range(total))
+        fallback = deque()
+        
+        # Keep only a small window of futures in flight so each wait() stays cheap
+        window = 2 * self.max_workers
+        pending = {}
+        
+        # Worker threads share the script context so their st.warning calls still render
+        with ThreadPoolExecutor(max_workers=self.max_workers, initializer=add_script_run_ctx,
+                                initargs=(None, get_script_run_ctx())) as executor:
+            def top_up():
+                while len(pending) < window:
+                    if fallback:
+                        start = fallback.popleft()
+                        pending[executor.submit(query_point, start)] = (start, False)
+                        continue
+                    task = next(tasks, None)
+                    if task is None:
+                        return
+                    start, fn, *args = task
+                    pending[executor.submit(fn, *args)] = (start, fn == self._query_batch)
+            
+            top_up()
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    start, is_batch = pending.pop(future)
+                    values = future.result()
+                    if values is None:
+                        # Bulk endpoint failed - fall back to per-point EPQS queries for this chunk
+                        fallback.extend(range(start, min(start + self.batch_size, total)))
+                        continue
+                    elevations[start:start + len(values)] = values
+                    from_batch[start:start + len(values)] = is_batch
+                    done += len(values)
+                    if on_progress:
+                        on_progress(done)
+                top_up()
+        
+        return elevations, from_batch
 
-    def get_elevation_for_coordinates(self, coordinates: List[Tuple[float, float]], 
-                                     point_ids: List[str] = None) -> pd.DataFrame:
-        """Get elevation for multiple coordinate pairs with progress tracking"""
-        results = []
-        total = len(coordinates)
+    def get_elevation_for_coordinates(self, lats: np.ndarray, lons: np.ndarray,
+                                     point_ids: Optional[np.ndarray] = None,
+                                     use_cache: bool = True) -> pd.DataFrame:
+        """Get elevation for parallel latitude/longitude arrays concurrently with progress tracking"""
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        total = lats.size
+        if point_ids is None:
+            point_ids = np.array([f"Point_{i+1}" for i in range(total)])
+        
+        # Only go to the network for points we haven't looked up before
+        # float32 keeps ~0.001 ft at 10,000 ft, far below the ~1.7 ft RMSE of the data
+        elevs = np.full(total, np.nan, dtype=np.float32)
+        ok = np.zeros(total, dtype=bool)
+        if use_cache:
+            sources = [EPQS_SOURCE] + ([self.batch_url] if self.batch_url else [])
+            for i, (lat, lon) in enumerate(zip(lats.tolist(), lons.tolist())):
+                for source in sources:
+                    cached = self.cache.get(lat, lon, source)
+                    if cached is not None:
+                        elevs[i] = cached
+                        ok[i] = True
+                        break
+        misses = np.flatnonzero(~ok)
+        cached_count = total - misses.size
         
         # Create progress bar
         progress_bar = st.progress(0)
         status_text = st.empty()
         
-        for i, (lat, lon) in enumerate(coordinates):
-            point_id = point_ids[i] if point_ids else f"Point_{i+1}"
-            status_text.text(f"Processing {point_id}: ({lat}, {lon}) - {i+1}/{total}")
-            
-            elevation = self.get_elevation_usgs(lat, lon)
-            
-            results.append({
-                'point_id': point_id,
-                'latitude': lat,
-                'longitude': lon,
-                'elevation_ft': elevation if elevation is not None else 'No Data',
-                'status': 'Success' if elevation is not None else 'Failed'
-            })
-            
-            # Update progress
-            progress_bar.progress((i + 1) / total)
+        # Each update is a round-trip to the browser, so refresh at most every
+        # ~1% of points or 200ms, whichever comes first
+        step = max(1, total // 100)
+        last_ui = {'done': 0, 'time': time.monotonic()}
+        
+        def show_progress(done: int):
+            status_text.text(f"Processing elevations - {done}/{total}")
+            progress_bar.progress(done / total)
+            last_ui['done'], last_ui['time'] = done, time.monotonic()
+        
+        def on_progress(done: int):
+            done += cached_count
+            if done - last_ui['done'] >= step or time.monotonic() - last_ui['time'] > 0.2:
+                show_progress(done)
+        
+        if misses.size:
+            miss_lats, miss_lons = lats[misses], lons[misses]
+            fetched, from_batch = self.get_elevations_batch(miss_lats, miss_lons, on_progress)
+            show_progress(total)
+            values = np.array([np.nan if elevation is None else elevation for elevation in fetched])
+            found = ~np.isnan(values)
+            elevs[misses[found]] = values[found]
+            ok[misses[found]] = True
             
-            # Rate limiting - be respectful to USGS
-            if i < total - 1:
-                time.sleep(0.5)
+            # Cache under the service that answered so batch results never pose as EPQS
+            for mask, source in ((found & ~from_batch, EPQS_SOURCE), (found & from_batch, self.batch_url)):
+                if mask.any():
+                    self.cache.update(zip(miss_lats[mask].tolist(), miss_lons[mask].tolist(),
+                                          values[mask].tolist()), source)
         
         status_text.text("✅ Processing complete!")
         progress_bar.empty()
         status_text.empty()
         
-        return pd.DataFrame(results)
+        return pd.DataFrame({
+            'point_id': point_ids,
+            'latitude': lats,
+            'longitude': lons,
+            'elevation_ft': elevs,
+            'status': np.where(ok, 'Success', 'Failed')
+        })
+
+@st.cache_resource
+def get_finder() -> USGSElevationFinder:
+    """Shared finder so its connection pool, rate limiter and cache survive reruns"""
+    return USGSElevationFinder(batch_url=os.environ.get("ELEVATION_BATCH_URL") or None)
+
+def format_for_display(df: pd.DataFrame) -> pd.DataFrame:
+    """Show missing elevations as 'No Data' for rendering and export"""
+    elevation = df['elevation_ft']
+    # astype(str) prints float32 at its own precision rather than widened float64 digits
+    return df.assign(elevation_ft=elevation.astype(str).where(elevation.notna(), 'No Data'))
+
+def to_csv_buffer(df: pd.DataFrame, chunksize: int = 50_000) -> io.BytesIO:
+    """Encode results as CSV bytes chunk by chunk, so only one chunk is formatted at a time"""
+    buf = io.BytesIO()
+    for start in range(0, max(len(df), 1), chunksize):
+        format_for_display(df.iloc[start:start + chunksize]).to_csv(buf, header=start == 0, index=False)
+    buf.seek(0)
+    return buf
 
 def validate_coordinates(lat: float, lon: float) -> Tuple[bool, str]:
     """Validate coordinate values"""
@@ -112,6 +450,10 @@ def main():
     if 'manual_points' not in st.session_state:
         st.session_state.manual_points = []
     
+    if get_finder().batch_url:
+        st.warning(f"⚠️ Bulk lookups use the batch service at {get_finder().batch_url}, "
+                   "which is typically less accurate than USGS; points it can't answer fall back to USGS.")
+    
     # Mode selection
     st.markdown("### Choose Your Input Method")
     mode = st.radio(
@@ -188,21 +530,23 @@ def manual_input_mode():
         
         # Process button
         if st.button("🏔️ Get Elevations for All Points", type="primary", use_container_width=True):
-            finder = USGSElevationFinder()
+            finder = get_finder()
             
-            coordinates = [(p['latitude'], p['longitude']) for p in st.session_state.manual_points]
-            point_ids = [p['point_id'] for p in st.session_state.manual_points]
+            lats = np.array([p['latitude'] for p in st.session_state.manual_points], dtype=np.float64)
+            lons = np.array([p['longitude'] for p in st.session_state.manual_points], dtype=np.float64)
+            point_ids = np.array([p['point_id'] for p in st.session_state.manual_points])
             
             with st.spinner("Processing elevations..."):
-                result_df = finder.get_elevation_for_coordinates(coordinates, point_ids)
+                result_df = finder.get_elevation_for_coordinates(lats, lons, point_ids)
             
             # Display results
             st.markdown("### ✅ Results")
-            st.dataframe(result_df, use_container_width=True)
+            st.dataframe(format_for_display(result_df), use_container_width=True)
             
             # Statistics
-            success_count = len(result_df[result_df['status'] == 'Success'])
-            failed_count = len(result_df[result_df['status'] == 'Failed'])
+            ok_mask = result_df['status'].to_numpy() == 'Success'
+            success_count = int(ok_mask.sum())
+            failed_count = ok_mask.size - success_count
             
             col1, col2, col3 = st.columns(3)
             col1.metric("Total Points", len(result_df))
@@ -210,7 +554,7 @@ def manual_input_mode():
             col3.metric("Failed", failed_count)
             
             # Download button
-            csv = result_df.to_csv(index=False)
+            csv = to_csv_buffer(result_df)
             st.download_button(
                 label="📥 Download Results as CSV",
                 data=csv,
@@ -236,25 +580,31 @@ def csv_upload_mode():
     
     if uploaded_file is not None:
         try:
-            # Read CSV
-            df = pd.read_csv(uploaded_file)
+            # Only parse the preview on reruns; the full file is read when processing starts
+            preview_df = pd.read_csv(uploaded_file, nrows=10)
+            columns = list(preview_df.columns)
             
-            st.success(f"✅ File uploaded successfully! ({df.shape[0]} rows, {df.shape[1]} columns)")
+            st.success(f"✅ File uploaded successfully! ({len(columns)} columns)")
             
             # Preview
             st.markdown("#### 👀 Data Preview")
-            st.dataframe(df.head(10), use_container_width=True)
+            st.dataframe(preview_df, use_container_width=True)
             
             # Column selection
             st.markdown("#### 📋 Column Selection")
-            columns = list(df.columns)
             
             col1, col2, col3 = st.columns(3)
             
-            # Auto-detect columns
-            id_col_default = next((col for col in columns if 'id' in col.lower()), columns[0])
-            lat_col_default = next((col for col in columns if 'lat' in col.lower()), columns[0])
-            lon_col_default = next((col for col in columns if 'lon' in col.lower() or 'lng' in col.lower()), columns[0])
+            # Auto-detect columns in a single pass
+            id_col_default = lat_col_default = lon_col_default = None
+            for col in columns:
+                lc = col.lower()
+                if id_col_default is None and 'id' in lc:
+                    id_col_default = col
+                if lat_col_default is None and 'lat' in lc:
+                    lat_col_default = col
+                if lon_col_default is None and ('lon' in lc or 'lng' in lc):
+                    lon_col_default = col
             
             with col1:
                 id_col = st.selectbox("Point ID Column", columns, 
@@ -271,45 +621,63 @@ def csv_upload_mode():
                 st.error("❌ Latitude and Longitude columns cannot be the same!")
                 return
             
+            use_cache = st.checkbox("Use cached elevations", value=True,
+                                    help="Reuse elevations already looked up for the same coordinates (rounded to ~1 m)")
+            
             # Process button
             if st.button("🏔️ Process Elevations", type="primary", use_container_width=True):
                 try:
-                    finder = USGSElevationFinder()
+                    finder = get_finder()
                     
-                    # Extract data
-                    coordinates = list(zip(df[lat_col], df[lon_col]))
-                    point_ids = df[id_col].astype(str).tolist()
+                    # Read the full file with the multithreaded pyarrow parser, reusing the
+                    # preview's column names so duplicate headers get the same de-duplicated names
+                    uploaded_file.seek(0)
+                    df = pd.read_csv(uploaded_file, engine='pyarrow', header=0, names=columns,
+                                     dtype={lat_col: 'float64', lon_col: 'float64'})
                     
-                    # Validate coordinates
-                    invalid_coords = []
-                    for i, (lat, lon) in enumerate(coordinates):
-                        valid, msg = validate_coordinates(lat, lon)
-                        if not valid:
-                            invalid_coords.append((i+1, point_ids[i], msg))
+                    # Validate coordinates in one vectorized pass (NaN counts as invalid),
+                    # bailing out before any other per-row work if the file is bad
+                    lat_arr = df[lat_col].to_numpy(dtype=np.float64)
+                    lon_arr = df[lon_col].to_numpy(dtype=np.float64)
+                    invalid_mask = ~((lat_arr >= -90) & (lat_arr <= 90) & (lon_arr >= -180) & (lon_arr <= 180))
                     
-                    if invalid_coords:
+                    if invalid_mask.any():
+                        n_bad = int(invalid_mask.sum())
                         st.error("❌ Invalid coordinates found:")
-                        for row, pid, msg in invalid_coords[:5]:  # Show first 5
-                            st.error(f"Row {row} ({pid}): {msg}")
-                        if len(invalid_coords) > 5:
-                            st.error(f"...and {len(invalid_coords)-5} more")
+                        for i in np.flatnonzero(invalid_mask)[:5]:  # Show first 5
+                            _, msg = validate_coordinates(lat_arr[i], lon_arr[i])
+                            st.error(f"Row {i+1} ({df[id_col].iloc[i]}): {msg}")
+                        if n_bad > 5:
+                            st.error(f"...and {n_bad-5} more")
                         return
                     
+                    # Extract data
+                    point_ids = df[id_col].astype(str).to_numpy()
+                    
+                    # Look up each distinct location once (rounded to ~1 m), then map back onto every row
+                    rounded_lat, rounded_lon = round_coordinates(lat_arr, lon_arr)
+                    rounded = pd.DataFrame({'lat': rounded_lat, 'lon': rounded_lon})
+                    first_rows = np.flatnonzero(~rounded.duplicated().to_numpy())
+                    group = rounded.groupby(['lat', 'lon'], sort=False).ngroup().to_numpy()
+                    
                     # Process elevations
-                    with st.spinner(f"Processing {len(coordinates)} locations..."):
-                        result_df = finder.get_elevation_for_coordinates(coordinates, point_ids)
+                    with st.spinner(f"Processing {first_rows.size} unique locations..."):
+                        unique_df = finder.get_elevation_for_coordinates(
+                            lat_arr[first_rows], lon_arr[first_rows], point_ids[first_rows], use_cache
+                        )
+                    result_df = unique_df[['elevation_ft', 'status']].iloc[group]
                     
-                    # Merge with original data
-                    final_df = df.copy()
-                    final_df['elevation_ft'] = result_df['elevation_ft'].values
-                    final_df['status'] = result_df['status'].values
+                    # Merge with original data (df is re-read on every run, so add the columns in place)
+                    df['elevation_ft'] = result_df['elevation_ft'].to_numpy()
+                    df['status'] = result_df['status'].to_numpy()
                     
                     # Display results
                     st.markdown("### ✅ Processing Complete!")
                     
                     # Statistics
-                    success_count = len(result_df[result_df['status'] == 'Success'])
-                    failed_count = len(result_df[result_df['status'] == 'Failed'])
+                    ok_mask = result_df['status'].to_numpy() == 'Success'
+                    success_count = int(ok_mask.sum())
+                    failed_count = ok_mask.size - success_count
                     
                     col1, col2, col3 = st.columns(3)
                     col1.metric("Total Points", len(result_df))
@@ -319,10 +687,10 @@ def csv_upload_mode():
                     # Show results
                     st.markdown("#### 📊 Results Preview")
                     display_cols = [id_col, lat_col, lon_col, 'elevation_ft', 'status']
-                    st.dataframe(final_df[display_cols].head(20), use_container_width=True)
+                    st.dataframe(format_for_display(df[display_cols].head(20)), use_container_width=True)
                     
                     # Download button
-                    csv = final_df.to_csv(index=False)
+                    csv = to_csv_buffer(df)
                     st.download_button(
                         label="📥 Download Complete Results as CSV",
                         data=csv,